@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 from pathlib import Path
@@ -55,15 +56,30 @@ def load_csv(
     if access_token is None:
         raise ValueError("ACCESS_TOKEN environment variable is not set")
 
-    importer = FireflyImporter(base_url=base_url, access_token=access_token)
+    with open(config_file, "r") as f:
+        csv_config = Config(**json5.load(f))
 
-    csv_config = Config(**json5.load(open(config_file, "r")))
-
-    importer.import_from_csv(
-        csv_file=csv_file,
-        csv_config=csv_config,
+    asyncio.run(
+        _import_csv(
+            base_url=base_url,
+            access_token=access_token,
+            csv_file=csv_file,
+            csv_config=csv_config,
+        )
     )
 
 
+async def _import_csv(
+    base_url: str, access_token: str, csv_file: str, csv_config: Config
+):
+    async with FireflyImporter(
+        base_url=base_url, access_token=access_token
+    ) as importer:
+        await importer.import_from_csv(
+            csv_file=csv_file,
+            csv_config=csv_config,
+        )
+
+
 if __name__ == "__main__":
     cli()
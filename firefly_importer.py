@@ -1,48 +1,186 @@
+import asyncio
 import csv
 import hashlib
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, Iterator
+from collections import defaultdict
+from datetime import datetime
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Tuple
 
-import requests
+import httpx
+import orjson
 
 from transaction import Config, Transaction
 
+# transient failures worth retrying; only 429 is retried for POSTs, since the others
+#  may arrive after the server has already created the transaction
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 5
+RETRY_BACKOFF = 0.3
+
+# the account types transactions can be imported into
+ACCOUNT_TYPES = ("asset", "liability", "liabilities")
+
+
+def _date_parser(date_format: str) -> Callable[[str], datetime]:
+    """Return a function parsing dates in the given format"""
+
+    def parse(value: str) -> datetime:
+        return datetime.strptime(value, date_format)
+
+    if date_format != "%Y-%m-%d":
+        return parse
+
+    def parse_iso(value: str) -> datetime:
+        # fromisoformat is implemented in C and much faster than strptime, but it
+        #  accepts other ISO forms (times, basic and week dates) that strptime
+        #  rejects, and rejects single-digit months, which strptime allows; only
+        #  use it for values shaped exactly like YYYY-MM-DD
+        if len(value) != 10 or value[4] != "-" or value[7] != "-":
+            return parse(value)
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return parse(value)
+
+    return parse_iso
+
 
 class FireflyImporter:
     def __init__(self, base_url: str, access_token: str):
         self.base_url = base_url.rstrip("/")
-        self.session = requests.Session()
-        self.session.headers.update(
-            {
+        self.client = httpx.AsyncClient(
+            # retry (only) failed connection attempts at the transport level;
+            #  see _request for retrying error responses
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=MAX_RETRIES,
+                # keep idle connections (and their negotiated HTTP/2 settings) around
+                #  for the lifetime of the importer rather than httpx's default of 5s
+                limits=httpx.Limits(keepalive_expiry=None),
+            ),
+            headers={
                 "Authorization": f"Bearer {access_token}",
                 "Accept": "application/json",
                 "Content-Type": "application/json",
-            }
+            },
+            timeout=30.0,
         )
-        self.account_map = self._get_account_map()
+        self.account_map: Dict[str, List[str]] = {}
+        self._existing_external_ids: set[str] = set()
+        self._transfer_index: Dict[Tuple, List[dict]] = defaultdict(list)
+        self._transfer_lock = asyncio.Lock()
 
         self.transactions_created = 0
         self.transactions_skipped = 0
         self.transfers_matched = 0
-
-    def _get_account_map(self) -> Dict[str, str]:
-        """Fetch all accounts and create a name -> id mapping"""
-        response = self.session.get(f"{self.base_url}/api/v1/accounts")
-        response.raise_for_status()
-        accounts = response.json()["data"]
-        return {account["attributes"]["name"]: account["id"] for account in accounts}
+        self.transactions_failed = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        """Make an API request, retrying transient failures with exponential backoff"""
+        retry_status_codes = RETRY_STATUS_CODES if method == "GET" else (429,)
+        for attempt in range(MAX_RETRIES):
+            response = await self.client.request(
+                method, f"{self.base_url}{path}", **kwargs
+            )
+            if response.status_code not in retry_status_codes:
+                return response
+            delay = RETRY_BACKOFF * 2**attempt
+            logging.warning(
+                "%s %s returned %d; retrying in %.1fs",
+                method,
+                path,
+                response.status_code,
+                delay,
+            )
+            await asyncio.sleep(delay)
+        return await self.client.request(method, f"{self.base_url}{path}", **kwargs)
+
+    async def _get_pages(self, path: str) -> AsyncIterator[dict]:
+        """Yield every item from a paginated API endpoint"""
+        page = 1
+        while True:
+            response = await self._request(
+                "GET", path, params={"page": page, "limit": 500}
+            )
+            response.raise_for_status()
+            body = orjson.loads(response.content)
+            for item in body["data"]:
+                yield item
+            if page >= body["meta"]["pagination"]["total_pages"]:
+                return
+            page += 1
+
+    async def _get_account_map(self) -> Dict[str, List[str]]:
+        """Fetch all asset and liability accounts and create a name -> ids mapping"""
+        # accounts of different types may share a name (importing deposits creates
+        #  a revenue account named after the asset account, for instance), so only
+        #  accounts that can be imported into are considered
+        account_map: Dict[str, List[str]] = defaultdict(list)
+        async for account in self._get_pages("/api/v1/accounts"):
+            if account["attributes"]["type"] in ACCOUNT_TYPES:
+                account_map[account["attributes"]["name"]].append(account["id"])
+        return account_map
+
+    async def _prefetch_transactions(self, account: str):
+        """Index the existing transactions of an account"""
+        # every transaction this importer creates, and every transfer it might
+        #  match, has the account as its source or destination, so there's no
+        #  need to hold the rest of the ledger in memory
+        if not self.account_map:
+            self.account_map = await self._get_account_map()
+        account_ids = self.account_map.get(account, [])
+        if not account_ids:
+            raise ValueError(f"Account {account!r} not found in Firefly III")
+        if len(account_ids) > 1:
+            raise ValueError(f"Account name {account!r} is ambiguous in Firefly III")
+        path = f"/api/v1/accounts/{account_ids[0]}/transactions"
+        async for group in self._get_pages(path):
+            self._index_transaction(group)
+
+    def _index_transaction(self, group: dict):
+        """Record a transaction group's external_ids and transfers for local lookup"""
+        for split in group["attributes"]["transactions"]:
+            if split.get("external_id"):
+                self._existing_external_ids.add(split["external_id"])
+            if split["type"] == "transfer":
+                key = self._transfer_key(
+                    float(split["amount"]),
+                    split["source_name"],
+                    split["destination_name"],
+                    datetime.fromisoformat(split["date"]).toordinal(),
+                )
+                self._transfer_index[key].append(group)
+
+    def _transfer_key(
+        self,
+        amount: float,
+        source_name: str | None,
+        destination_name: str | None,
+        day: int,
+    ) -> Tuple:
+        """Key transfers by amount, accounts and (ordinal) date"""
+        return (round(abs(amount), 2), source_name, destination_name, day)
 
     def _generate_external_id(
         self, transaction: Transaction, additional_uid_value: str | None
     ) -> str:
         """Generate a stable external ID for deduplication"""
+        # the digest (algorithm and key format) must not change, or transactions
+        #  imported previously will no longer be recognised as duplicates
         key = f"{transaction.date.isoformat()}-{transaction.amount}-{transaction.account}-{transaction.description}"
         if additional_uid_value:
             key += f"-{additional_uid_value}"
         return hashlib.sha256(key.encode()).hexdigest()
 
-    def import_from_csv(self, csv_file: str, csv_config: Config):
+    async def import_from_csv(
+        self, csv_file: str, csv_config: Config, concurrency: int = 10
+    ):
         """
         Import transactions from CSV file
 
@@ -50,29 +188,77 @@ class FireflyImporter:
             csv_files: Dict mapping account names to CSV file paths
             date_format: Format string for parsing dates in CSVs
             csv_config: Dict with column names for date, description, and amount
+            concurrency: Maximum number of transactions processed at once
         """
-        transactions = self._parse_csv_transactions(csv_file, csv_config)
+        await self._prefetch_transactions(csv_config.account)
 
-        for transaction in transactions:
-            if self._find_transaction_by_external_id(transaction.external_id):
-                logging.info(f"Transaction {transaction.external_id} already exists")
-                self.transactions_skipped += 1
-                continue
-
-            if transaction.type == "transfer":
-                transfer = self._find_matching_transfer(
-                    transaction, csv_config.date_window_days
-                )
-                if transfer:
-                    logging.info(f"Matching transfer found: {transfer['id']}")
-                    self.transfers_matched += 1
-                    continue
-
-            self._create_transaction(transaction)
+        transactions = self._parse_csv_transactions(csv_file, csv_config)
 
-        print(f"Created {self.transactions_created} transactions")
-        print(f"Skipped {self.transactions_skipped} transactions")
-        print(f"Transfers matched: {self.transfers_matched}")
+        # the workers share the one generator, so rows are read from the CSV only as
+        #  fast as they can be processed; duplicate rows have identical external_ids
+        #  and payloads, so it doesn't matter which of them is handled first, and
+        #  transfers are serialised in _process
+        async def worker():
+            for transaction in transactions:
+                await self._process(transaction, csv_config.date_window_days)
+
+        # a TaskGroup cancels the remaining workers as soon as one of them fails,
+        #  rather than leaving them to carry on importing behind the caller's back
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for _ in range(concurrency):
+                    tg.create_task(worker())
+        except ExceptionGroup as e:
+            raise e.exceptions[0]
+        finally:
+            print(f"Created {self.transactions_created} transactions")
+            print(f"Skipped {self.transactions_skipped} transactions")
+            print(f"Transfers matched: {self.transfers_matched}")
+            if self.transactions_failed:
+                print(f"Failed to create {self.transactions_failed} transactions")
+
+    async def _process(self, transaction: Transaction, date_window_days: int | None):
+        """Skip, match or create a single transaction"""
+        # claim the external_id before awaiting anything, so that a duplicate row
+        #  being processed concurrently is skipped rather than created twice
+        if transaction.external_id in self._existing_external_ids:
+            logging.info(f"Transaction {transaction.external_id} already exists")
+            self.transactions_skipped += 1
+            return
+        self._existing_external_ids.add(transaction.external_id)
+
+        if transaction.type != "transfer":
+            await self._try_create_transaction(transaction)
+            return
+
+        # match and create transfers one at a time, so that a transfer created for
+        #  one row is indexed before the next row looks for a match, as it would be
+        #  if rows were processed serially
+        async with self._transfer_lock:
+            transfer = self._find_matching_transfer(transaction, date_window_days)
+            if transfer:
+                logging.info(f"Matching transfer found: {transfer['id']}")
+                self.transfers_matched += 1
+                return
+            await self._try_create_transaction(transaction)
+
+    async def _try_create_transaction(self, transaction: Transaction):
+        """Create a transaction, logging (rather than raising) API errors"""
+        try:
+            await self._create_transaction(transaction)
+        except httpx.HTTPError as e:
+            # a single bad row shouldn't abort the rest of the import; release the
+            #  external_id so that a later run will try this transaction again (if
+            #  the server did create it, that run's prefetch will find it)
+            logging.error(
+                "Failed to create %s: %f - %s (%s)",
+                transaction.type,
+                transaction.amount,
+                transaction.description,
+                e.response.text if isinstance(e, httpx.HTTPStatusError) else repr(e),
+            )
+            self._existing_external_ids.discard(transaction.external_id)
+            self.transactions_failed += 1
 
     def _parse_csv_transactions(
         self, filepath: str, config: Config
@@ -81,13 +267,20 @@ class FireflyImporter:
 
         account = config.account
 
-        date_format = config.date_format
+        parse_date = _date_parser(config.date_format)
         date_column = config.date_column
+        # bank exports repeat the same few dates across many rows
+        dates: Dict[str, datetime] = {}
 
         description_column = config.description_column
         amount_column = config.amount_column
         credit_column = config.credit_column
         debit_column = config.debit_column
+        invert_amount = config.invert_amount
+        additional_uid_column = config.additional_uid_column
+
+        get_transfer = config.transfer_map.get
+        generate_external_id = self._generate_external_id
 
         if amount_column is None:
             if credit_column is None or debit_column is None:
@@ -95,16 +288,32 @@ class FireflyImporter:
                     "If amount_column is not provided, both credit_column and debit_column must be provided"
                 )
 
+        # only the columns we actually read need stripping, not the whole row
+        used_columns = {
+            column
+            for column in (
+                date_column,
+                description_column,
+                amount_column,
+                credit_column,
+                debit_column,
+                additional_uid_column,
+                "Check",
+                "Description",
+            )
+            if column
+        }
+
         with open(filepath, "r", newline="") as csvfile:
             reader = csv.DictReader(csvfile)
-            for i, row in reversed(list(enumerate(reader))):
-                row = {
-                    k: v.strip() if isinstance(v, str) else v for k, v in row.items()
-                }
+            for i, row in enumerate(reader):
+                for column in used_columns:
+                    if isinstance(value := row.get(column), str):
+                        row[column] = value.strip()
 
                 if amount_column is not None:
                     amount = float(row[amount_column])
-                    if config.invert_amount:
+                    if invert_amount:
                         amount = 0 - amount
                 elif row[credit_column] == "":
                     amount = 0 - float(row[debit_column])
@@ -115,8 +324,12 @@ class FireflyImporter:
                 if row.get("Check", None):
                     description += row["Check"]
 
+                date = dates.get(row[date_column])
+                if date is None:
+                    date = dates[row[date_column]] = parse_date(row[date_column])
+
                 transaction = Transaction(
-                    date=datetime.strptime(row[date_column], date_format),
+                    date=date,
                     description=description,
                     amount=amount,
                     account=account,
@@ -126,29 +339,30 @@ class FireflyImporter:
                 transaction.type = "withdrawal" if transaction.amount < 0 else "deposit"
 
                 additional_uid_value = None
-                if config.additional_uid_column:
-                    if config.additional_uid_column == "idx":
+                if additional_uid_column:
+                    if additional_uid_column == "idx":
                         additional_uid_value = str(i)
                     else:
-                        additional_uid_value = row[config.additional_uid_column]
+                        additional_uid_value = row[additional_uid_column]
 
-                transaction.external_id = self._generate_external_id(
+                # every row needs its external_id, even on a re-run where most will be
+                #  skipped: matching (date, amount, description) against Firefly III
+                #  can't prove a row was imported, since it ignores the additional uid
+                #  and stored descriptions may since have been changed by rules or edits
+                transaction.external_id = generate_external_id(
                     transaction, additional_uid_value
                 )
 
-                if destination := config.transfers_out.get(row["Description"]):
+                if transfer := get_transfer(row["Description"]):
                     transaction.type = "transfer"
+                    transaction.source_name, transaction.destination_name = transfer
+                else:
                     transaction.source_name = account
-                    transaction.destination_name = destination
-
-                if source := config.transfers_in.get(row["Description"]):
-                    transaction.type = "transfer"
-                    transaction.source_name = source
-                    transaction.destination_name = account
+                    transaction.destination_name = "Cash" if amount < 0 else account
 
                 yield transaction
 
-    def _create_transaction(self, transaction: Transaction):
+    async def _create_transaction(self, transaction: Transaction):
         """Create a regular transaction"""
 
         data = {
@@ -159,14 +373,17 @@ class FireflyImporter:
                     "amount": str(abs(transaction.amount)),
                     "description": transaction.description,
                     "external_id": transaction.external_id,
-                    "source_name": transaction.source_name or transaction.account,
-                    "destination_name": transaction.destination_name
-                    or ("Cash" if transaction.amount < 0 else transaction.account),
+                    "source_name": transaction.source_name,
+                    "destination_name": transaction.destination_name,
                 }
             ],
         }
 
-        response = self.session.post(f"{self.base_url}/api/v1/transactions", json=data)
+        response = await self._request(
+            "POST", "/api/v1/transactions", content=orjson.dumps(data)
+        )
+        response.raise_for_status()
+        self._index_transaction(orjson.loads(response.content)["data"])
         logging.info(
             "Created %s: %f - %s",
             transaction.type,
@@ -174,55 +391,29 @@ class FireflyImporter:
             transaction.description,
         )
         self.transactions_created += 1
-        response.raise_for_status()
-
-    def _find_transaction_by_external_id(self, external_id):
-        """Search for existing transaction with this external_id."""
-        response = self.session.get(
-            f"{self.base_url}/api/v1/search/transactions",
-            params={"query": f"external_id_is:{external_id}"},
-        )
-        results = response.json().get("data", [])
-        return results[0] if results else None
 
     def _find_matching_transfer(
         self, transaction: Transaction, date_window_days: int | None
-    ):
-        """Search for existing transaction with this external_id."""
-
-        query_params = {
-            "type": "transfer",
-            "amount": str(abs(transaction.amount)),
-            "source_account_is": f'"{transaction.source_name or transaction.account}"',
-            "destination_account_is": f'"{transaction.destination_name}"',
-            # don't match if the description is the same;
-            #  sometimes we may have two transactions in the same direction between
-            #  the same two accounts for the same amount on the same day;
-            #  this should prevent the second one being skipped as a duplicate
-            "-description_is": f'"{transaction.description}"',
-        }
-
-        if date_window_days is None:
-            query_params["date_on"] = transaction.date.strftime("%Y-%m-%d")
-        else:
-            query_params["date_after"] = (
-                transaction.date - timedelta(days=date_window_days)
-            ).strftime("%Y-%m-%d")
-            query_params["date_before"] = (
-                transaction.date + timedelta(days=date_window_days)
-            ).strftime("%Y-%m-%d")
-
-        query = self._dict_to_search_query(query_params)
-
-        logging.debug(f"Searching for: {query}")
-
-        response = self.session.get(
-            f"{self.base_url}/api/v1/search/transactions",
-            params={"query": query},
-        )
-        results = response.json().get("data", [])
-        return results[0] if results else None
-
-    def _dict_to_search_query(self, data):
-        """Convert a dictionary of key-value pairs into a Firefly III search query."""
-        return " ".join([":".join([k, v]) for k, v in data.items()])
+    ) -> dict | None:
+        """Look up an existing transfer matching this transaction."""
+
+        window = date_window_days or 0
+        day = transaction.date.toordinal()
+        for candidate_day in range(day - window, day + window + 1):
+            key = self._transfer_key(
+                transaction.amount,
+                transaction.source_name,
+                transaction.destination_name,
+                candidate_day,
+            )
+            for group in self._transfer_index.get(key, []):
+                # don't match if the description is the same;
+                #  sometimes we may have two transactions in the same direction between
+                #  the same two accounts for the same amount on the same day;
+                #  this should prevent the second one being skipped as a duplicate
+                if all(
+                    split["description"] != transaction.description
+                    for split in group["attributes"]["transactions"]
+                ):
+                    return group
+        return None
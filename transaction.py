@@ -1,9 +1,9 @@
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 
 
-@dataclass
+@dataclass(slots=True)
 class Transaction:
     date: datetime
     description: str
@@ -15,7 +15,7 @@ class Transaction:
     destination_name: Optional[str] = None
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Config:
     account: str
     description_column: str
@@ -29,3 +29,18 @@ class Config:
     additional_uid_column: str | None = None
     transfers_out: Dict[str, str] = field(default_factory=dict)
     transfers_in: Dict[str, str] = field(default_factory=dict)
+    # description -> (source_name, destination_name) for transfers in either direction
+    transfer_map: Dict[str, Tuple[str, str]] = field(
+        init=False, repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        transfer_map = {
+            description: (self.account, destination)
+            for description, destination in self.transfers_out.items()
+        }
+        transfer_map.update(
+            (description, (source, self.account))
+            for description, source in self.transfers_in.items()
+        )
+        object.__setattr__(self, "transfer_map", transfer_map)